@@ -0,0 +1,83 @@
+import hashlib
+import os
+import shutil
+import uuid
+from pathlib import Path
+from typing import BinaryIO
+
+
+# Persistent cache shared across requests (precompiled preamble formats, PDFs).
+CACHE_ROOT = Path(os.environ.get("LATEX_CACHE_DIR", "/var/cache/latex-render"))
+PDF_CACHE_MAX_ENTRIES = int(os.environ.get("PDF_CACHE_MAX", "256"))
+
+
+def content_hasher():
+    # Fed incrementally by callers that already stream the content elsewhere;
+    # hexdigest() gives the same key as content_key.
+    return hashlib.blake2b(digest_size=16)
+
+
+def content_key(f: BinaryIO, chunk_size: int = 1 << 20) -> str:
+    # Hashes the rest of f, then rewinds it.
+    h = content_hasher()
+    start = f.tell()
+    while chunk := f.read(chunk_size):
+        h.update(chunk)
+    f.seek(start)
+    return h.hexdigest()
+
+
+def touch(path: Path) -> None:
+    # mtime doubles as the LRU timestamp (atime is unreliable with noatime mounts).
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+def trim_lru(cache_dir: Path, max_entries: int) -> None:
+    try:
+        entries = [(p.stat().st_mtime, p) for p in cache_dir.iterdir()]
+    except OSError:
+        return
+    entries.sort(reverse=True)
+    for _, p in entries[max_entries:]:
+        if p.is_dir():
+            shutil.rmtree(p, ignore_errors=True)
+        else:
+            p.unlink(missing_ok=True)
+
+
+def _pdf_path(key: str) -> Path:
+    return CACHE_ROOT / "pdf" / f"{key}.pdf"
+
+
+def _link_or_copy(src: Path, dst: Path) -> None:
+    # Cached PDFs are never modified in place, so a hard link is as good as a copy.
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def get_cached_pdf(key: str, dest: Path) -> bool:
+    path = _pdf_path(key)
+    try:
+        _link_or_copy(path, dest)
+    except OSError:
+        return False
+    touch(path)
+    return True
+
+
+def put_cached_pdf(key: str, pdf_path: Path) -> None:
+    path = _pdf_path(key)
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Stage under a unique name, then rename: readers never see a partial PDF.
+        tmp = path.with_name(f".{key}.{uuid.uuid4().hex}.tmp")
+        _link_or_copy(pdf_path, tmp)
+        os.replace(tmp, path)
+    except OSError:
+        return  # caching is best-effort
+    trim_lru(path.parent, PDF_CACHE_MAX_ENTRIES)
@@ -1,68 +1,255 @@
-import io
+import fcntl
+import hashlib
+import json
+import os
 import re
+import shutil
+import signal
 import subprocess
 import tempfile
+import threading
+import uuid
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import BinaryIO
+
+from app.cache import CACHE_ROOT, touch, trim_lru
+
+
+TEXMF_CACHE_ROOT = CACHE_ROOT / "texmf"
+FMT_CACHE_MAX_ENTRIES = int(os.environ.get("LATEX_FMT_CACHE_MAX", "32"))
+FMT_NAME = "precompile"
+# Variants kept per preamble text (same preamble, different local inputs).
+FMT_VARIANTS_MAX = 4
+EXTRACT_WORKERS = 8
+COPY_BUFSIZE = 1 << 20
+# Members up to this size are decompressed in one go and written with a single
+# write(2) on a raw fd instead of going through a buffered file object.
+SMALL_MEMBER_MAX = 256 << 10
+# pdflatex's per-pass outputs (.aux, .log, .toc, .fls, the PDF itself) go to a
+# tmpfs when one with room to spare is available (Docker's default /dev/shm is
+# only 64 MiB, too small for big PDFs). LATEX_OUTPUT_ROOT overrides the choice.
+SHM_MIN_FREE_BYTES = 1 << 30
+
+
+def _default_output_root() -> str | None:
+    if os.environ.get("LATEX_OUTPUT_ROOT"):
+        return os.environ["LATEX_OUTPUT_ROOT"]
+    try:
+        st = os.statvfs("/dev/shm")
+    except OSError:
+        return None
+    if st.f_bavail * st.f_frsize < SHM_MIN_FREE_BYTES:
+        return None
+    return "/dev/shm"
+
+
+OUTPUT_ROOT = _default_output_root()
+# Only the end of a tool's output is ever reported, so that's all _run keeps.
+LOG_TAIL_BYTES = 16384
+# Upper bound on pdflatex passes when latexmk isn't available.
+MAX_LATEX_PASSES = 4
+
+# \dump drops open \write streams, so preambles that open one (index, glossary,
+# nomenclature, raw \openout) would silently lose that output under a format.
+_WRITE_STREAM_RE = re.compile(
+    r"\\(?:makeindex|makeglossaries|makeglossary|makenomenclature|openout)(?![A-Za-z@])"
+)
+# Signs that pdflatex couldn't load the precompiled format at all.
+_FMT_FAILURE_RE = re.compile(r"Fatal format file error|I can't find the format file|---! .*\.fmt")
+# Files TeX can pick up from the main file's directory without the preamble
+# naming them: local copies of classes/packages, optional .cfg files, ...
+_FMT_VISIBLE_SUFFIXES = frozenset({".sty", ".cls", ".cfg", ".def", ".clo", ".fd", ".bst", ".tex"})
+# Examples (common across editors):
+#   % !TEX root = main.tex
+#   % !TeX root=../thesis.tex
+_MAGIC_ROOT_RE = re.compile(r"^\s*%+\s*!\s*tex\s+root\s*=\s*(.+?)\s*$", re.I | re.M)
+
+# TEXMFVAR/TEXMFCACHE for TeX runs in this process (see claim_texmf_slot).
+_texmf_var: Path | None = None
+_texmf_slot_lock = None
+
+
+def claim_texmf_slot(max_slots: int) -> None:
+    """
+    Point this process's TeX runs at a persistent TEXMFVAR/TEXMFCACHE slot under
+    the cache root, so font maps and other TeX caches survive across requests
+    and restarts. Slots are held with an flock so concurrent workers never
+    share one.
+    """
+    global _texmf_var, _texmf_slot_lock
+    for i in range(max_slots):
+        slot = TEXMF_CACHE_ROOT / f"slot-{i}"
+        try:
+            slot.mkdir(parents=True, exist_ok=True)
+            lock = open(slot / ".lock", "wb")
+        except OSError:
+            return
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock.close()
+            continue
+        _texmf_slot_lock = lock  # held for the life of the process
+        _texmf_var = slot
+        return
 
 
-def _run(cmd: list[str], cwd: Path, timeout_s: int) -> str:
-    p = subprocess.run(
+def _tex_env(extra: dict[str, str] | None = None) -> dict[str, str] | None:
+    env = dict(extra or {})
+    if _texmf_var is not None:
+        env["TEXMFVAR"] = env["TEXMFCACHE"] = str(_texmf_var)
+    if not env:
+        return None
+    return {**os.environ, **env}
+
+
+def _run(
+    cmd: list[str],
+    cwd: Path,
+    timeout_s: int,
+    tail: int = LOG_TAIL_BYTES,
+    env: dict[str, str] | None = None,
+) -> str:
+    # Own session so a timeout also kills whatever latexmk spawned; otherwise
+    # the grandchild keeps the pipe open and the read below never ends.
+    p = subprocess.Popen(
         cmd,
         cwd=str(cwd),
         stdout=subprocess.PIPE,
         stderr=subprocess.STDOUT,
-        timeout=timeout_s,
+        env=_tex_env(env),
+        start_new_session=True,
     )
-    out = p.stdout or b""
+    timed_out = threading.Event()
+
+    def kill() -> None:
+        timed_out.set()
+        try:
+            os.killpg(p.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    timer = threading.Timer(timeout_s, kill)
+    timer.start()
+    # Keep a rolling tail rather than buffering MBs of TeX output.
+    out = bytearray()
+    try:
+        while chunk := p.stdout.read(1 << 16):
+            out += chunk
+            if len(out) > tail:
+                del out[:-tail]
+        p.wait()
+    finally:
+        timer.cancel()
+        if p.poll() is None:
+            kill()
+            p.wait()
+        p.stdout.close()
+
+    if timed_out.is_set():
+        raise subprocess.TimeoutExpired(cmd, timeout_s)
     # Tool output isn't always valid UTF-8; avoid crashing on decode.
     return out.decode("utf-8", errors="replace")
 
 
-def _read_text(path: Path) -> str:
+def _write_file(path: str, data: bytes) -> None:
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+
+def _extract_zip(zip_file: BinaryIO, workdir: Path) -> None:
+    root = str(workdir.resolve()) + os.sep
+
+    with zipfile.ZipFile(zip_file) as z:
+        # Destination -> entry. Later entries with the same name replace earlier
+        # ones (as unzip does), so no two threads ever write the same file.
+        files: dict[str, zipfile.ZipInfo] = {}
+        for info in z.infolist():
+            # Reject absolute paths / "../" traversal (zip slip). Lexical check:
+            # the tree is freshly created and zipfile never writes symlinks, so
+            # there's nothing for resolve() to follow.
+            dst = os.path.normpath(os.path.join(root, info.filename))
+            if not (dst + os.sep).startswith(root):
+                raise RuntimeError(f"Zip entry escapes project dir: {info.filename}")
+            if info.is_dir():
+                os.makedirs(dst, exist_ok=True)
+            else:
+                files[dst] = info
+
+        def extract(item: tuple[str, zipfile.ZipInfo]) -> None:
+            dst, info = item
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            # ZipFile serializes the underlying reads itself; decompression and
+            # the file writes overlap across threads.
+            if info.file_size <= SMALL_MEMBER_MAX:
+                _write_file(dst, z.read(info))
+                return
+            with z.open(info) as src, open(dst, "wb") as out:
+                shutil.copyfileobj(src, out, COPY_BUFSIZE)
+
+        with ThreadPoolExecutor(max_workers=max(1, min(EXTRACT_WORKERS, len(files)))) as ex:
+            list(ex.map(extract, files.items()))
+
+
+def _read_bytes(path: Path) -> bytes:
+    try:
+        return path.read_bytes()
+    except OSError:
+        return b""
+
+
+def _read_head(path: Path, n: int = 8192) -> str:
+    # \documentclass, \begin{document} and "% !TEX root" markers sit at the top
+    # of a file; classifying a .tex doesn't need the rest of it.
     try:
-        return path.read_text(errors="ignore")
+        with open(path, "rb") as f:
+            return f.read(n).decode("utf-8", errors="ignore")
+    except Exception:
+        return ""
+
+
+def _read_tail(path: Path, n: int = 8192) -> str:
+    # \end{document} sits at the bottom; in a long paper it is far past the head.
+    try:
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size <= n:
+                return ""
+            f.seek(max(n, size - n))
+            return f.read().decode("utf-8", errors="ignore")
     except Exception:
         return ""
 
 
 def _extract_magic_root(text: str) -> str | None:
-    # Examples (common across editors):
-    #   % !TEX root = main.tex
-    #   % !TeX root=../thesis.tex
-    m = re.search(r"(?im)^\s*%+\s*!\s*tex\s+root\s*=\s*(.+?)\s*$", text)
+    m = _MAGIC_ROOT_RE.search(text)
     if not m:
         return None
     root = m.group(1).strip().strip('"').strip("'")
     return root or None
 
 
-def _pick_magic_root(workdir: Path) -> Path | None:
-    workdir_resolved = workdir.resolve()
-    hits: dict[Path, int] = {}
-
-    for tex_path in workdir.rglob("*.tex"):
-        text = _read_text(tex_path)
-        if not text:
-            continue
-        root_rel = _extract_magic_root(text)
-        if not root_rel:
-            continue
-
-        candidate = (tex_path.parent / root_rel).resolve()
-        try:
-            candidate.relative_to(workdir_resolved)
-        except ValueError:
-            continue
-
-        if candidate.exists() and candidate.is_file():
-            hits[candidate] = hits.get(candidate, 0) + 1
+def _resolve_magic_root(tex_path: Path, text: str, workdir_resolved: Path) -> Path | None:
+    root_rel = _extract_magic_root(text)
+    if not root_rel:
+        return None
 
-    if not hits:
+    candidate = (tex_path.parent / root_rel).resolve()
+    try:
+        candidate.relative_to(workdir_resolved)
+    except ValueError:
         return None
 
-    # Prefer the most-referenced root; break ties by shorter path.
-    return max(hits.items(), key=lambda kv: (kv[1], -len(str(kv[0]))))[0]
+    if candidate.exists() and candidate.is_file():
+        return candidate
+    return None
 
 
 def _score_tex_candidate(tex_path: Path, text: str) -> tuple[int, int]:
@@ -82,92 +269,372 @@ def _score_tex_candidate(tex_path: Path, text: str) -> tuple[int, int]:
     return score, -len(str(tex_path))
 
 
+def _iter_tex_files(root: Path):
+    # os.scandir-based walk; entry types come from readdir, so no extra stat per file.
+    stack = [root]
+    while stack:
+        d = stack.pop()
+        try:
+            with os.scandir(d) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(Path(entry.path))
+                    elif entry.name.endswith(".tex") and entry.is_file():
+                        yield Path(entry.path)
+        except OSError:
+            continue
+
+
 def _pick_main_tex(workdir: Path) -> Path:
-    # 1) If the project explicitly declares a root via magic comment, honor it.
-    magic_root = _pick_magic_root(workdir)
-    if magic_root is not None:
-        return magic_root
+    # 0) Fast path for the common layout: a real document at ./main.tex that
+    #    doesn't itself defer to another root. No walk needed.
+    main = workdir / "main.tex"
+    if main.is_file():
+        head = _read_head(main)
+        if "\\documentclass" in head and not _extract_magic_root(head):
+            return main
+
+    # Single walk over the project: each .tex head is read once and feeds both
+    # the magic-root check and the heuristic score.
+    workdir_resolved = workdir.resolve()
+    scored: list[tuple[int, int, Path]] = []
+
+    for tex_path in _iter_tex_files(workdir):
+        text = _read_head(tex_path)
+        # 1) If the project explicitly declares a root via magic comment, honor
+        #    the first one that resolves inside the project.
+        root = _resolve_magic_root(tex_path, text, workdir_resolved)
+        if root is not None:
+            return root
+        score, tie = _score_tex_candidate(tex_path, text + _read_tail(tex_path))
+        scored.append((score, tie, tex_path))
 
     # 2) Common convention: main.tex at root
-    main = workdir / "main.tex"
     if main.exists():
         return main
 
     # 3) Heuristics: pick the best-scoring .tex file
-    tex_files = list(workdir.rglob("*.tex"))
-    if not tex_files:
+    if not scored:
         raise RuntimeError("No .tex file found in the zip.")
 
-    scored: list[tuple[int, int, Path]] = []
-    for tex_path in tex_files:
-        text = _read_text(tex_path)
-        score, tie = _score_tex_candidate(tex_path, text)
-        scored.append((score, tie, tex_path))
-
     scored.sort(reverse=True)
     return scored[0][2]
 
 
-def compile_zip_bytes_to_pdf(zip_bytes: bytes) -> bytes:
-    with tempfile.TemporaryDirectory() as tmp:
-        workdir = Path(tmp) / "proj"
-        workdir.mkdir(parents=True, exist_ok=True)
+def _extract_preamble(text: str) -> str | None:
+    idx = text.find("\\begin{document}")
+    if idx < 0 or "\\documentclass" not in text[:idx]:
+        return None
+    return text[:idx]
 
-        # unzip
+
+def _format_key(main_tex: Path, preamble: str) -> str | None:
+    # Preamble text plus every file TeX could see next to main_tex. A local
+    # IEEEtran.cls or hyperref.cfg changes what the preamble means even when the
+    # build of some other project never opened such a file.
+    h = hashlib.sha256(preamble.encode("utf-8", errors="ignore"))
+    try:
+        visible = sorted(
+            p
+            for p in main_tex.parent.iterdir()
+            if p.suffix.lower() in _FMT_VISIBLE_SUFFIXES and p.name != main_tex.name and p.is_file()
+        )
+        for p in visible:
+            h.update(p.name.encode() + b"\0")
+            h.update(hashlib.sha256(p.read_bytes()).digest())
+    except OSError:
+        return None
+    return h.hexdigest()
+
+
+def _format_inputs(fls_path: Path, tex_dir: Path, project_dir: Path, exclude: Path) -> list[str] | None:
+    # Project files the format build read (\input'd macros, packages in
+    # subdirectories, ...), relative to tex_dir, which is where TeX resolves them
+    # from. None if the recorder file is missing.
+    try:
+        fls = fls_path.read_text(errors="ignore")
+    except OSError:
+        return None
+    root = str(project_dir) + os.sep
+    inputs: set[str] = set()
+    outputs: set[str] = set()
+    for line in fls.splitlines():
+        kind, _, name = line.partition(" ")
+        if kind in ("INPUT", "OUTPUT"):
+            path = os.path.normpath(os.path.join(tex_dir, name))
+            (inputs if kind == "INPUT" else outputs).add(path)
+    return sorted(
+        os.path.relpath(p, tex_dir)
+        for p in inputs - outputs
+        if p.startswith(root) and p != str(exclude)
+    )
+
+
+def _hash_inputs(tex_dir: Path, names: list[str]) -> dict[str, str] | None:
+    hashes: dict[str, str] = {}
+    for name in names:
         try:
-            with zipfile.ZipFile(io.BytesIO(zip_bytes)) as z:
-                z.extractall(workdir)
-        except zipfile.BadZipFile:
-            raise RuntimeError("Invalid zip file.")
+            hashes[name] = hashlib.sha256((tex_dir / name).read_bytes()).hexdigest()
+        except OSError:
+            return None
+    return hashes
 
-        main_tex = _pick_main_tex(workdir)
-        tex_dir = main_tex.parent
-        stem = main_tex.stem
-        tex_name = main_tex.name
 
-        logs = ""
+def _lookup_format(entry: Path, tex_dir: Path) -> Path | None | bool:
+    # Returns the format path for a variant whose recorded inputs match this
+    # project, False for a matching variant that was found unusable, and None
+    # when nothing matches.
+    try:
+        variants = [v for v in entry.iterdir() if not v.name.startswith(".")]
+    except OSError:
+        return None
+    for variant in variants:
         try:
-            # latexmk handles multi-pass compilation + bibliography tools more reliably than
-            # hand-rolling pdflatex/biber/bibtex steps.
-            logs += _run(
-                [
-                    "latexmk",
-                    "-pdf",
-                    f"-pdflatex=pdflatex -interaction=nonstopmode -halt-on-error -no-shell-escape -file-line-error %O %S",
-                    tex_name,
-                ],
-                cwd=tex_dir,
-                timeout_s=300,
-            )
-        except FileNotFoundError:
-            # Fallback for environments that don't have latexmk installed.
-            base_cmd = [
+            manifest = json.loads((variant / "inputs.json").read_text())
+        except (OSError, ValueError):
+            continue
+        inputs = manifest["inputs"]
+        if _hash_inputs(tex_dir, sorted(inputs)) != inputs:
+            continue
+        touch(entry)
+        touch(variant)
+        if not manifest["usable"]:
+            return False
+        return variant / FMT_NAME
+    return None
+
+
+def _precompiled_format(main_tex: Path, project_dir: Path, out_dir: Path) -> Path | None:
+    """
+    Return the path (without extension) of a mylatexformat .fmt for main_tex's
+    preamble, building it on first use. None means "compile without a format".
+
+    Formats are shared across requests. The cache key covers the preamble and
+    every TeX-visible file next to main_tex, and each format also records the
+    hashes of every project file its build read; it's only reused when all of
+    them match.
+    """
+    preamble = _extract_preamble(_read_bytes(main_tex).decode("utf-8", errors="ignore"))
+    if preamble is None or _WRITE_STREAM_RE.search(preamble):
+        return None
+
+    tex_dir = main_tex.parent.resolve()
+    project_dir = project_dir.resolve()
+    key = _format_key(main_tex, preamble)
+    if key is None:
+        return None
+    fmt_root = CACHE_ROOT / "fmt"
+    entry = fmt_root / key
+
+    found = _lookup_format(entry, tex_dir)
+    if found is not None:
+        return found or None
+
+    # mylatexformat dumps everything up to \begin{document} (or \endofdump).
+    # Run from the project dir so local packages in the preamble resolve; the
+    # .fmt/.log/.fls go to the job's out_dir, not next to the sources.
+    job = f"{FMT_NAME}-{os.getpid()}"
+    try:
+        _run(
+            [
                 "pdflatex",
+                "-ini",
+                "-recorder",
                 "-interaction=nonstopmode",
                 "-halt-on-error",
                 "-no-shell-escape",
-                "-file-line-error",
-                tex_name,
-            ]
+                f"-jobname={job}",
+                f"-output-directory={out_dir}",
+                "&pdflatex",
+                "mylatexformat.ltx",
+                main_tex.name,
+            ],
+            cwd=tex_dir,
+            timeout_s=120,
+        )
+    except (FileNotFoundError, subprocess.TimeoutExpired):
+        return None
 
-            # pass 1
-            logs += _run(base_cmd, cwd=tex_dir, timeout_s=90)
+    built = out_dir / f"{job}.fmt"
+    names = _format_inputs(out_dir / f"{job}.fls", tex_dir, project_dir, main_tex.resolve())
+    inputs = _hash_inputs(tex_dir, names) if names is not None else None
+    for ext in ("log", "fls"):
+        (out_dir / f"{job}.{ext}").unlink(missing_ok=True)
+    if inputs is None:
+        built.unlink(missing_ok=True)
+        return None
 
-            # bibliography (biber if .bcf exists; else bibtex if .aux exists)
-            bcf = tex_dir / f"{stem}.bcf"
-            aux = tex_dir / f"{stem}.aux"
-            if bcf.exists():
-                logs += _run(["biber", stem], cwd=tex_dir, timeout_s=60)
-            elif aux.exists():
-                logs += _run(["bibtex", stem], cwd=tex_dir, timeout_s=60)
+    # Inputs that open write streams are just as lossy as the preamble doing it.
+    usable = built.exists() and not any(
+        _WRITE_STREAM_RE.search(_read_bytes(tex_dir / name).decode("utf-8", errors="ignore"))
+        for name in inputs
+    )
 
-            # passes 2-3
-            logs += _run(base_cmd, cwd=tex_dir, timeout_s=90)
+    # Assemble the variant under a private name, then rename it into place so
+    # readers never see a format without its manifest.
+    variant_id = hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()[:16]
+    variant = entry / variant_id
+    staging = entry / f".{uuid.uuid4().hex}"
+    try:
+        staging.mkdir(parents=True)
+        if usable:
+            # out_dir is usually on another filesystem than the cache.
+            shutil.move(str(built), staging / f"{FMT_NAME}.fmt")
+        (staging / "inputs.json").write_text(json.dumps({"inputs": inputs, "usable": usable}))
+        os.rename(staging, variant)
+    except OSError:
+        # Lost a race with an identical build, or the cache isn't writable.
+        shutil.rmtree(staging, ignore_errors=True)
+        if not (variant / "inputs.json").exists():
+            built.unlink(missing_ok=True)
+            return None
+    finally:
+        built.unlink(missing_ok=True)
+
+    trim_lru(entry, FMT_VARIANTS_MAX)
+    trim_lru(fmt_root, FMT_CACHE_MAX_ENTRIES)
+    if not (variant / f"{FMT_NAME}.fmt").exists():
+        return None
+    return variant / FMT_NAME
+
+
+def _rerun_state(cwd: Path, out_dir: Path, stem: str) -> dict[str, bytes]:
+    # Digests of the files pdflatex both wrote and read back (.aux, .toc, .out, ...),
+    # taken from the -recorder .fls. Once a pass leaves them unchanged, another
+    # pass would produce the same output.
+    names = {str(out_dir / f"{stem}.aux")}
+    inputs: set[str] = set()
+    outputs: set[str] = set()
+    try:
+        fls = (out_dir / f"{stem}.fls").read_text(errors="ignore")
+    except OSError:
+        fls = ""
+    for line in fls.splitlines():
+        kind, _, name = line.partition(" ")
+        if kind == "INPUT":
+            inputs.add(os.path.normpath(os.path.join(cwd, name)))
+        elif kind == "OUTPUT":
+            outputs.add(os.path.normpath(os.path.join(cwd, name)))
+    names |= inputs & outputs
+
+    state: dict[str, bytes] = {}
+    for name in sorted(names):
+        try:
+            state[name] = hashlib.sha256(Path(name).read_bytes()).digest()
+        except OSError:
+            pass
+    return state
+
+
+def _compile_tex(main_tex: Path, fmt: Path | None, out_dir: Path) -> str:
+    tex_dir = main_tex.parent
+    stem = main_tex.stem
+    tex_name = main_tex.name
+    fmt_args = [f"-fmt={fmt}"] if fmt is not None else []
+    fmt_opt = "".join(f"{a} " for a in fmt_args)
+
+    logs = ""
+    try:
+        # latexmk handles multi-pass compilation + bibliography tools more reliably than
+        # hand-rolling pdflatex/biber/bibtex steps.
+        logs += _run(
+            [
+                "latexmk",
+                "-pdf",
+                f"-outdir={out_dir}",
+                f"-pdflatex=pdflatex {fmt_opt}-interaction=nonstopmode -halt-on-error -no-shell-escape -file-line-error %O %S",
+                tex_name,
+            ],
+            cwd=tex_dir,
+            timeout_s=300,
+        )
+    except FileNotFoundError:
+        # Fallback for environments that don't have latexmk installed.
+        base_cmd = [
+            "pdflatex",
+            *fmt_args,
+            "-recorder",
+            f"-output-directory={out_dir}",
+            "-interaction=nonstopmode",
+            "-halt-on-error",
+            "-no-shell-escape",
+            "-file-line-error",
+            tex_name,
+        ]
+
+        state = None
+        for n in range(MAX_LATEX_PASSES):
             logs += _run(base_cmd, cwd=tex_dir, timeout_s=90)
 
-        pdf_path = tex_dir / f"{stem}.pdf"
-        if not pdf_path.exists():
-            # Return tail of logs to help your agent fix errors quickly
-            raise RuntimeError("PDF not produced. Log tail:\n" + logs[-8000:])
+            if n == 0:
+                # bibliography: biber if biblatex declared a datasource, bibtex if
+                # the .aux asks for one; nothing for documents without citations.
+                bcf = _read_bytes(out_dir / f"{stem}.bcf")
+                aux = _read_bytes(out_dir / f"{stem}.aux")
+                if b"<bcf:datasource" in bcf:
+                    # biber looks for the .bcf in --output-directory and resolves
+                    # .bib files against cwd.
+                    logs += _run(
+                        ["biber", f"--output-directory={out_dir}", stem],
+                        cwd=tex_dir,
+                        timeout_s=60,
+                    )
+                elif b"\\bibdata" in aux or b"\\citation" in aux:
+                    # bibtex works next to the .aux; point it back at the sources
+                    # (trailing separator keeps the default search path).
+                    search = f"{tex_dir}{os.pathsep}"
+                    logs += _run(
+                        ["bibtex", stem],
+                        cwd=out_dir,
+                        timeout_s=60,
+                        env={"BIBINPUTS": search, "BSTINPUTS": search},
+                    )
+
+            # Stop as soon as a pass reproduces the auxiliary files it read.
+            new_state = _rerun_state(tex_dir, out_dir, stem)
+            if new_state == state:
+                break
+            state = new_state
+
+    return logs
+
+
+def compile_zip_to_pdf(zip_file: BinaryIO, dest: Path) -> None:
+    # The build dir is gone once this returns; the PDF is moved out to dest.
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = Path(tmp) / "proj"
+        workdir.mkdir(parents=True, exist_ok=True)
+
+        # unzip
+        try:
+            _extract_zip(zip_file, workdir)
+        except zipfile.BadZipFile:
+            raise RuntimeError("Invalid zip file.")
+
+        main_tex = _pick_main_tex(workdir)
+        tex_dir = main_tex.parent
+        stem = main_tex.stem
 
-        return pdf_path.read_bytes()
+        with tempfile.TemporaryDirectory(prefix="lrx-", dir=OUTPUT_ROOT) as out:
+            out_dir = Path(out)
+            # \include{chapters/x} writes chapters/x.aux under the output dir,
+            # and TeX won't create the subdirectory itself.
+            for dirpath, dirnames, _ in os.walk(tex_dir):
+                rel = os.path.relpath(dirpath, tex_dir)
+                for d in dirnames:
+                    (out_dir / rel / d).mkdir(exist_ok=True)
+
+            pdf_path = out_dir / f"{stem}.pdf"
+
+            fmt = _precompiled_format(main_tex, workdir, out_dir)
+            logs = _compile_tex(main_tex, fmt, out_dir)
+            if fmt is not None and not pdf_path.exists() and _FMT_FAILURE_RE.search(logs):
+                # The format itself couldn't be loaded; retry plainly. Ordinary
+                # document errors aren't retried.
+                logs += _compile_tex(main_tex, None, out_dir)
+
+            if not pdf_path.exists():
+                # Return tail of logs to help your agent fix errors quickly
+                raise RuntimeError("PDF not produced. Log tail:\n" + logs[-8000:])
+
+            shutil.move(str(pdf_path), dest)
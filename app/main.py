@@ -1,22 +1,164 @@
+import asyncio
+import multiprocessing
 import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+from pathlib import Path
+
 from fastapi import FastAPI, Header, HTTPException
-from fastapi.responses import Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse
 from pydantic import BaseModel
 
 from app.spaces import (
     get_s3_client,
     make_zip_object_key,
     presign_put_zip,
-    fetch_object_bytes,
+    open_object,
+    download_body,
     delete_object,
 )
-from app.latex_compile import compile_zip_bytes_to_pdf
+from app.cache import content_hasher, get_cached_pdf, put_cached_pdf
+from app.latex_compile import OUTPUT_ROOT, SHM_MIN_FREE_BYTES
+from app.worker import compile_zip_path, init_compile_worker
 
 
 APP_API_KEY = os.environ.get("APP_API_KEY", "")
 SPACES_BUCKET = os.environ.get("SPACES_BUCKET", "")
 
-app = FastAPI(title="LaTeX Render API")
+COMPILE_WORKERS = int(os.environ.get("COMPILE_WORKERS", "0")) or os.cpu_count() or 1
+JOB_DIR_PREFIX = "latex-render-"
+STALE_JOB_DIR_SECONDS = 3600
+
+
+def _make_executor() -> ProcessPoolExecutor:
+    # forkserver: workers start from a clean single-threaded process instead of
+    # a fork of this one (threadpool threads, locks possibly held mid-fork).
+    return ProcessPoolExecutor(
+        max_workers=COMPILE_WORKERS,
+        mp_context=multiprocessing.get_context("forkserver"),
+        initializer=init_compile_worker,
+        initargs=(COMPILE_WORKERS,),
+    )
+
+
+# Compiles are CPU-bound, so they run in worker processes; the semaphore keeps
+# at most one in-flight job per worker instead of piling up a backlog.
+EXECUTOR = _make_executor()
+COMPILE_SLOTS = asyncio.Semaphore(COMPILE_WORKERS)
+
+
+def _open_upload(key: str):
+    # Runs in the threadpool: client setup and the request stay off the loop.
+    return open_object(get_s3_client(), SPACES_BUCKET, key)
+
+
+def _new_job_dir(upload_size: int) -> Path:
+    # Small uploads stay off container disk: the job dir goes on OUTPUT_ROOT
+    # (tmpfs) when the upload still leaves the headroom the compiles expect.
+    root = None
+    if OUTPUT_ROOT:
+        try:
+            st = os.statvfs(OUTPUT_ROOT)
+            if st.f_bavail * st.f_frsize - upload_size >= SHM_MIN_FREE_BYTES:
+                root = OUTPUT_ROOT
+        except OSError:
+            pass
+    return Path(tempfile.mkdtemp(prefix=JOB_DIR_PREFIX, dir=root))
+
+
+def _spool_upload(body, job_dir: Path) -> tuple[Path, str]:
+    # Runs in the threadpool; the cache key is hashed from the same stream, so
+    # the zip is written once and not read back.
+    zip_path = job_dir / "upload.zip"
+    h = content_hasher()
+    download_body(body, zip_path, h)
+    return zip_path, h.hexdigest()
+
+
+class _JobFileResponse(FileResponse):
+    # Removes the request's job dir once sending ends, however it ends:
+    # Starlette skips `background` tasks when the client disconnects mid-send.
+    def __init__(self, path: Path, job_dir: Path, **kwargs):
+        super().__init__(path, **kwargs)
+        self.job_dir = job_dir
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            shutil.rmtree(self.job_dir, ignore_errors=True)
+
+
+def _sweep_stale_job_dirs() -> None:
+    # Job dirs left behind by a crashed or killed server process.
+    cutoff = time.time() - STALE_JOB_DIR_SECONDS
+    roots = {tempfile.gettempdir()}
+    if OUTPUT_ROOT:
+        roots.add(OUTPUT_ROOT)
+    for root in roots:
+        for p in Path(root).glob(f"{JOB_DIR_PREFIX}*"):
+            try:
+                if p.is_dir() and p.stat().st_mtime < cutoff:
+                    shutil.rmtree(p, ignore_errors=True)
+            except OSError:
+                pass
+
+
+# In-flight upload deletions; referenced here so they aren't garbage-collected.
+_PENDING_DELETES: set[asyncio.Task] = set()
+
+
+def _delete_upload(key: str) -> None:
+    # Runs in the threadpool, so a first-use client build never blocks the loop.
+    delete_object(get_s3_client(), SPACES_BUCKET, key)
+
+
+def _schedule_delete(key: str) -> None:
+    # Deleting the upload doesn't affect the response, so it overlaps with
+    # sending it instead of delaying it.
+    async def delete():
+        try:
+            await run_in_threadpool(_delete_upload, key)
+        except Exception:
+            pass  # not fatal
+
+    task = asyncio.create_task(delete())
+    _PENDING_DELETES.add(task)
+    task.add_done_callback(_PENDING_DELETES.discard)
+
+
+async def _run_in_pool(fn, *args):
+    global EXECUTOR
+    executor = EXECUTOR
+    try:
+        return await asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+    except BrokenProcessPool:
+        # A worker died (OOM kill, segfault) and took the pool with it; replace
+        # the pool so later requests aren't all failed by it.
+        if EXECUTOR is executor:
+            EXECUTOR = _make_executor()
+            executor.shutdown(wait=False, cancel_futures=True)
+        raise
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await run_in_threadpool(_sweep_stale_job_dirs)
+    # Start the compile workers up front so the first requests don't pay for
+    # process startup on top of their compile.
+    await asyncio.gather(*(_run_in_pool(os.getpid) for _ in range(COMPILE_WORKERS)))
+    yield
+    if _PENDING_DELETES:
+        await asyncio.gather(*_PENDING_DELETES, return_exceptions=True)
+    EXECUTOR.shutdown(wait=False, cancel_futures=True)
+
+
+app = FastAPI(title="LaTeX Render API", lifespan=lifespan)
 
 
 def require_api_key(x_api_key: str | None):
@@ -55,23 +197,36 @@ class CompileRequest(BaseModel):
 
 
 @app.post("/compile")
-def compile(req: CompileRequest, x_api_key: str | None = Header(default=None)):
+async def compile(req: CompileRequest, x_api_key: str | None = Header(default=None)):
     require_api_key(x_api_key)
 
     if not req.key.startswith("uploads/") or not req.key.endswith(".zip"):
         raise HTTPException(status_code=400, detail="Invalid key")
 
-    s3 = get_s3_client()
+    job_dir: Path | None = None
     try:
-        zip_bytes = fetch_object_bytes(s3, SPACES_BUCKET, req.key)
-        pdf_bytes = compile_zip_bytes_to_pdf(zip_bytes)
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
-    finally:
-        if req.delete_after:
-            try:
-                delete_object(s3, SPACES_BUCKET, req.key)
-            except Exception:
-                pass  # not fatal
-
-    return Response(content=pdf_bytes, media_type="application/pdf")
+        try:
+            body, size = await run_in_threadpool(_open_upload, req.key)
+            job_dir = _new_job_dir(size)
+            pdf_path = job_dir / "output.pdf"
+            zip_path, cache_key = await run_in_threadpool(_spool_upload, body, job_dir)
+            # Identical uploads (preview/CI loops) are served from the PDF cache
+            # without waiting for a compile slot.
+            if not await run_in_threadpool(get_cached_pdf, cache_key, pdf_path):
+                async with COMPILE_SLOTS:
+                    await _run_in_pool(compile_zip_path, str(zip_path), str(pdf_path))
+                await run_in_threadpool(put_cached_pdf, cache_key, pdf_path)
+        except BrokenProcessPool:
+            raise HTTPException(status_code=503, detail="Compile worker crashed; please retry.")
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        finally:
+            if req.delete_after:
+                _schedule_delete(req.key)
+    except BaseException:
+        if job_dir is not None:
+            shutil.rmtree(job_dir, ignore_errors=True)
+        raise
+
+    # Stream the PDF from disk instead of holding it in memory, then drop its dir.
+    return _JobFileResponse(pdf_path, job_dir, media_type="application/pdf")
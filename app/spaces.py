@@ -1,11 +1,17 @@
 import os
+import threading
 import uuid
 from datetime import datetime, timezone
+from pathlib import Path
 
 import boto3
 from botocore.client import Config
 
-def get_s3_client():
+_s3_client = None
+_s3_client_lock = threading.Lock()
+
+
+def _make_s3_client():
     # Example endpoint: https://nyc3.digitaloceanspaces.com
     endpoint = os.environ["SPACES_ENDPOINT"]
     region = os.environ["SPACES_REGION"]
@@ -18,10 +24,26 @@ def get_s3_client():
         endpoint_url=endpoint,
         aws_access_key_id=key,
         aws_secret_access_key=secret,
-        config=Config(signature_version="s3v4"),
+        config=Config(
+            signature_version="s3v4",
+            max_pool_connections=50,
+            tcp_keepalive=True,
+        ),
     )
 
 
+def get_s3_client():
+    # One client per process, built on first use and shared across requests
+    # (botocore clients are thread-safe). Only the API process calls this;
+    # compile workers never talk to S3.
+    global _s3_client
+    if _s3_client is None:
+        with _s3_client_lock:
+            if _s3_client is None:
+                _s3_client = _make_s3_client()
+    return _s3_client
+
+
 def make_zip_object_key(prefix: str = "uploads") -> str:
     # uploads/2025-12-30/<uuid>.zip
     day = datetime.now(timezone.utc).strftime("%Y-%m-%d")
@@ -41,9 +63,24 @@ def presign_put_zip(s3, bucket: str, key: str, expires_seconds: int = 300) -> st
     )
 
 
-def fetch_object_bytes(s3, bucket: str, key: str) -> bytes:
+def open_object(s3, bucket: str, key: str):
+    # Streaming body plus its size, so the caller can pick where to spool it
+    # before reading anything.
     obj = s3.get_object(Bucket=bucket, Key=key)
-    return obj["Body"].read()
+    return obj["Body"], obj["ContentLength"]
+
+
+def download_body(body, dest: Path, hasher=None, chunk_size: int = 1 << 20) -> None:
+    # Streams the body to dest, feeding each chunk to hasher on the way so the
+    # file never has to be read back; the upload never sits in memory whole.
+    try:
+        with open(dest, "wb") as f:
+            for chunk in body.iter_chunks(chunk_size):
+                f.write(chunk)
+                if hasher is not None:
+                    hasher.update(chunk)
+    finally:
+        body.close()
 
 
 def delete_object(s3, bucket: str, key: str) -> None:
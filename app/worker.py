@@ -0,0 +1,21 @@
+import os
+from pathlib import Path
+
+from app.latex_compile import claim_texmf_slot, compile_zip_to_pdf
+
+
+# Everything here runs inside compile pool workers. It lives apart from
+# app.main so workers don't import FastAPI or create a second executor.
+
+
+def init_compile_worker(max_slots: int):
+    # pdflatex is single-threaded; keep any helper libraries from oversubscribing
+    # cores, and give each worker its own TeX var dir so they don't contend on it.
+    os.environ["OMP_NUM_THREADS"] = "1"
+    claim_texmf_slot(max_slots)
+
+
+def compile_zip_path(zip_path: str, pdf_path: str) -> None:
+    # Paths, not file objects or bytes, cross the process boundary.
+    with open(zip_path, "rb") as zip_file:
+        compile_zip_to_pdf(zip_file, Path(pdf_path))
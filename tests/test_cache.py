@@ -0,0 +1,58 @@
+import io
+import os
+
+from app import cache
+
+
+def test_content_key_hashes_rest_of_file_and_rewinds():
+    f = io.BytesIO(b"zip-bytes")
+    key = cache.content_key(f, chunk_size=3)
+    assert key == cache.content_key(io.BytesIO(b"zip-bytes"))
+    assert key != cache.content_key(io.BytesIO(b"other"))
+    assert f.tell() == 0
+
+
+def test_content_hasher_matches_content_key():
+    h = cache.content_hasher()
+    for chunk in (b"zip-", b"bytes"):
+        h.update(chunk)
+    assert h.hexdigest() == cache.content_key(io.BytesIO(b"zip-bytes"))
+
+
+def test_pdf_cache_miss_then_hit(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "CACHE_ROOT", tmp_path / "cache")
+    dest = tmp_path / "out.pdf"
+    assert cache.get_cached_pdf("k", dest) is False
+    assert not dest.exists()
+
+    src = tmp_path / "built.pdf"
+    src.write_bytes(b"%PDF-1.5")
+    cache.put_cached_pdf("k", src)
+    src.unlink()  # the cache keeps its own link/copy
+
+    assert cache.get_cached_pdf("k", dest) is True
+    assert dest.read_bytes() == b"%PDF-1.5"
+
+
+def test_put_cached_pdf_replaces_existing_entry(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "CACHE_ROOT", tmp_path / "cache")
+    for body in (b"old", b"new"):
+        src = tmp_path / f"{body.decode()}.pdf"
+        src.write_bytes(body)
+        cache.put_cached_pdf("k", src)
+    cache.get_cached_pdf("k", tmp_path / "out.pdf")
+    assert (tmp_path / "out.pdf").read_bytes() == b"new"
+    assert [p.name for p in (tmp_path / "cache" / "pdf").iterdir()] == ["k.pdf"]
+
+
+def test_trim_lru_keeps_most_recently_used(tmp_path):
+    for i, name in enumerate(["a", "b", "c", "d"]):
+        p = tmp_path / name
+        if name == "d":
+            p.mkdir()  # format cache entries are directories
+        else:
+            p.write_text(name)
+        os.utime(p, (1000 + i, 1000 + i))
+    cache.touch(tmp_path / "a")  # a hit makes the oldest entry the newest
+    cache.trim_lru(tmp_path, 2)
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["a", "d"]
@@ -0,0 +1,407 @@
+import io
+import json
+import os
+import subprocess
+import sys
+import time
+import zipfile
+from pathlib import Path
+
+import pytest
+
+from app import latex_compile as lc
+
+
+def _zip(*names: str) -> io.BytesIO:
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as z:
+        for name in names:
+            # ZipInfo keeps the name verbatim (writestr(str) would sanitize it).
+            z.writestr(zipfile.ZipInfo(name), "x")
+    buf.seek(0)
+    return buf
+
+
+# --- zip extraction -----------------------------------------------------------
+
+
+@pytest.mark.parametrize("name", ["../evil.tex", "a/../../evil.tex", "/etc/evil.tex"])
+def test_extract_zip_rejects_entries_outside_project(tmp_path, name):
+    workdir = tmp_path / "proj"
+    workdir.mkdir()
+    with pytest.raises(RuntimeError, match="escapes project dir"):
+        lc._extract_zip(_zip("main.tex", name), workdir)
+    assert not (tmp_path / "evil.tex").exists()
+
+
+def test_extract_zip_normalizes_dot_segments(tmp_path):
+    lc._extract_zip(_zip("./main.tex", "chapters/./a/../b.tex"), tmp_path)
+    assert (tmp_path / "main.tex").read_text() == "x"
+    assert (tmp_path / "chapters" / "b.tex").read_text() == "x"
+
+
+def test_extract_zip_creates_empty_directories(tmp_path):
+    lc._extract_zip(_zip("main.tex", "figs/", "build/out/"), tmp_path)
+    assert (tmp_path / "figs").is_dir()
+    assert (tmp_path / "build" / "out").is_dir()
+
+
+@pytest.mark.filterwarnings("ignore:Duplicate name")
+def test_extract_zip_duplicate_name_keeps_last_entry(tmp_path):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as z:
+        z.writestr("main.tex", "first")
+        z.writestr("./main.tex", "second")
+        z.writestr("main.tex", "third")
+    buf.seek(0)
+    lc._extract_zip(buf, tmp_path)
+    assert (tmp_path / "main.tex").read_text() == "third"
+
+
+# --- subprocess runner --------------------------------------------------------
+
+
+def test_run_keeps_bounded_tail(tmp_path):
+    script = "import sys; sys.stdout.write('x' * 200000 + 'END')"
+    out = lc._run([sys.executable, "-c", script], tmp_path, timeout_s=30, tail=1000)
+    assert len(out) == 1000
+    assert out.endswith("xEND")
+
+
+def test_run_timeout_kills_process_group(tmp_path):
+    # The background sleep inherits stdout; unless the whole group is killed it
+    # holds the pipe open and _run blocks for its full 30s.
+    start = time.monotonic()
+    with pytest.raises(subprocess.TimeoutExpired):
+        lc._run(["sh", "-c", "sleep 30 & sleep 30"], tmp_path, timeout_s=1)
+    assert time.monotonic() - start < 10
+
+
+# --- main file discovery ------------------------------------------------------
+
+
+def test_pick_main_tex_fast_path_skips_walk(tmp_path, monkeypatch):
+    (tmp_path / "main.tex").write_text("\\documentclass{article}\n\\begin{document}\\end{document}")
+    (tmp_path / "other.tex").write_text("\\documentclass{book}")
+    (tmp_path / "ch.tex").write_text("% !TEX root = other.tex\n")
+
+    def no_walk(root):
+        raise AssertionError("walked the project")
+
+    monkeypatch.setattr(lc, "_iter_tex_files", no_walk)
+    assert lc._pick_main_tex(tmp_path) == tmp_path / "main.tex"
+
+
+def test_pick_main_tex_follows_magic_root_in_main_tex(tmp_path):
+    (tmp_path / "main.tex").write_text("% !TeX root=thesis.tex\n\\documentclass{article}")
+    (tmp_path / "thesis.tex").write_text("\\documentclass{book}")
+    assert lc._pick_main_tex(tmp_path) == (tmp_path / "thesis.tex").resolve()
+
+
+def test_pick_main_tex_long_paper_beats_standalone_figure(tmp_path):
+    body = "Lorem ipsum dolor sit amet.\n" * 2000
+    (tmp_path / "paper.tex").write_text(
+        "\\documentclass{article}\n\\begin{document}\n" + body + "\\end{document}\n"
+    )
+    assert (tmp_path / "paper.tex").stat().st_size > 50_000
+    (tmp_path / "figs").mkdir()
+    (tmp_path / "figs" / "plot.tex").write_text(
+        "\\documentclass{standalone}\n\\begin{document}\nx\n\\end{document}\n"
+    )
+    assert lc._pick_main_tex(tmp_path) == tmp_path / "paper.tex"
+
+
+def test_pick_main_tex_first_magic_root_wins(tmp_path, monkeypatch):
+    for name in ("one.tex", "two.tex"):
+        (tmp_path / name).write_text("\\documentclass{article}")
+    (tmp_path / "a.tex").write_text("% !TEX root = one.tex\n")
+    (tmp_path / "b.tex").write_text("% !TEX root = two.tex\n")
+    (tmp_path / "c.tex").write_text("% !TEX root = two.tex\n")
+
+    order = [tmp_path / n for n in ("a.tex", "b.tex", "c.tex", "one.tex", "two.tex")]
+    monkeypatch.setattr(lc, "_iter_tex_files", lambda root: iter(order))
+    read = []
+    real_read_head = lc._read_head
+    monkeypatch.setattr(lc, "_read_head", lambda p, *a: read.append(p) or real_read_head(p, *a))
+
+    assert lc._pick_main_tex(tmp_path) == (tmp_path / "one.tex").resolve()
+    # The walk stops at the first hit instead of tallying every magic comment.
+    assert read == [tmp_path / "a.tex"]
+
+
+def test_pick_main_tex_falls_back_to_scoring(tmp_path):
+    (tmp_path / "chapters").mkdir()
+    (tmp_path / "chapters" / "intro.tex").write_text("Intro text.")
+    (tmp_path / "thesis.tex").write_text("\\documentclass{book}\n\\begin{document}\\end{document}")
+    assert lc._pick_main_tex(tmp_path) == tmp_path / "thesis.tex"
+
+
+# --- precompiled preamble formats ---------------------------------------------
+
+PREAMBLE = "\\documentclass{IEEEtran}\n\\input{defs.inc}\n"
+
+
+def _fake_format_build(monkeypatch, tmp_path, reads=("defs.inc",)):
+    # Stands in for `pdflatex -ini ... mylatexformat.ltx main.tex`: writes the
+    # .fmt and a recorder file listing `reads` (relative to the build's cwd).
+    monkeypatch.setattr(lc, "CACHE_ROOT", tmp_path / "cache")
+    builds = []
+
+    def fake_run(cmd, cwd, timeout_s, tail=lc.LOG_TAIL_BYTES, env=None):
+        assert cmd[:2] == ["pdflatex", "-ini"]
+        builds.append(cwd)
+        out_dir = Path(next(a for a in cmd if a.startswith("-output-directory=")).split("=", 1)[1])
+        job = next(a for a in cmd if a.startswith("-jobname=")).split("=", 1)[1]
+        (out_dir / f"{job}.fmt").write_bytes(b"fmt")
+        lines = ["INPUT /usr/share/texmf/tex/latex/IEEEtran/IEEEtran.cls", f"INPUT ./{cmd[-1]}"]
+        lines += [f"INPUT {r}" for r in reads]
+        lines.append(f"OUTPUT {out_dir}/{job}.log")
+        (out_dir / f"{job}.fls").write_text("\n".join(lines) + "\n")
+        return ""
+
+    monkeypatch.setattr(lc, "_run", fake_run)
+    return builds
+
+
+def _fmt_project(root: Path, files: dict[str, str], main: str = "main.tex", preamble: str = PREAMBLE) -> Path:
+    for name, text in {main: preamble + "\\begin{document}x\\end{document}", **files}.items():
+        path = root / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(text)
+    return root / main
+
+
+def _precompile(main: Path, project: Path, out_dir: Path) -> Path | None:
+    out_dir.mkdir(parents=True, exist_ok=True)
+    return lc._precompiled_format(main, project, out_dir)
+
+
+def test_format_reused_for_identical_project(tmp_path, monkeypatch):
+    builds = _fake_format_build(monkeypatch, tmp_path)
+    a = _fmt_project(tmp_path / "a", {"defs.inc": "A"})
+    b = _fmt_project(tmp_path / "b", {"defs.inc": "A"})
+    fmt_a = _precompile(a, tmp_path / "a", tmp_path / "out-a")
+    fmt_b = _precompile(b, tmp_path / "b", tmp_path / "out-b")
+    assert fmt_a is not None and fmt_a == fmt_b
+    assert len(builds) == 1
+
+
+def test_format_build_writes_only_to_out_dir(tmp_path, monkeypatch):
+    _fake_format_build(monkeypatch, tmp_path)
+    a = _fmt_project(tmp_path / "a", {"defs.inc": "x"})
+    before = sorted(p.name for p in (tmp_path / "a").iterdir())
+    assert _precompile(a, tmp_path / "a", tmp_path / "out-a") is not None
+    assert sorted(p.name for p in (tmp_path / "a").iterdir()) == before
+    assert list((tmp_path / "out-a").iterdir()) == []
+
+
+def test_format_not_reused_when_recorded_input_differs(tmp_path, monkeypatch):
+    builds = _fake_format_build(monkeypatch, tmp_path)
+    a = _fmt_project(tmp_path / "a", {"defs.inc": "A"})
+    b = _fmt_project(tmp_path / "b", {"defs.inc": "B"})
+    assert _precompile(a, tmp_path / "a", tmp_path / "out-a") != _precompile(b, tmp_path / "b", tmp_path / "out-b")
+    assert len(builds) == 2
+
+
+@pytest.mark.parametrize("local_file", ["IEEEtran.cls", "hyperref.cfg", "local.sty"])
+def test_format_not_reused_when_unopened_local_file_appears(tmp_path, monkeypatch, local_file):
+    # The build of `a` never opened the local file (it didn't exist), so only
+    # the directory listing in the key can tell the two projects apart.
+    builds = _fake_format_build(monkeypatch, tmp_path)
+    a = _fmt_project(tmp_path / "a", {"defs.inc": "A"})
+    b = _fmt_project(tmp_path / "b", {"defs.inc": "A", local_file: "% local copy"})
+    assert _precompile(a, tmp_path / "a", tmp_path / "out-a") != _precompile(b, tmp_path / "b", tmp_path / "out-b")
+    assert len(builds) == 2
+
+
+def test_format_inputs_resolve_from_main_file_dir(tmp_path, monkeypatch):
+    # `b` keeps its main file in a subdirectory; TeX reads sub/defs.inc, not
+    # the root-level defs.inc that happens to match `a`'s.
+    builds = _fake_format_build(monkeypatch, tmp_path)
+    a = _fmt_project(tmp_path / "a", {"defs.inc": "A"})
+    b = _fmt_project(tmp_path / "b", {"defs.inc": "A", "sub/defs.inc": "B"}, main="sub/main.tex")
+    _precompile(a, tmp_path / "a", tmp_path / "out-a")
+    _precompile(b, tmp_path / "b", tmp_path / "out-b")
+    assert len(builds) == 2
+    manifests = list((tmp_path / "cache" / "fmt").glob("*/*/inputs.json"))
+    assert all(json.loads(m.read_text())["inputs"].keys() == {"defs.inc"} for m in manifests)
+
+
+def test_format_skipped_when_preamble_opens_write_stream(tmp_path, monkeypatch):
+    builds = _fake_format_build(monkeypatch, tmp_path)
+    a = _fmt_project(tmp_path / "a", {"defs.inc": "A"}, preamble=PREAMBLE + "\\makeindex\n")
+    assert _precompile(a, tmp_path / "a", tmp_path / "out-a") is None
+    assert builds == []
+
+
+def test_format_unusable_when_input_opens_write_stream_is_cached(tmp_path, monkeypatch):
+    builds = _fake_format_build(monkeypatch, tmp_path)
+    a = _fmt_project(tmp_path / "a", {"defs.inc": "\\makeglossaries"})
+    assert _precompile(a, tmp_path / "a", tmp_path / "out-a") is None
+    assert _precompile(a, tmp_path / "a", tmp_path / "out-a2") is None
+    assert len(builds) == 1
+
+
+@pytest.mark.parametrize("log, runs", [("! Undefined control sequence.", 1), ("Fatal format file error; I'm stymied", 2)])
+def test_plain_retry_only_on_format_failure(tmp_path, monkeypatch, log, runs):
+    monkeypatch.setattr(lc, "_precompiled_format", lambda main_tex, *args: tmp_path / "precompile")
+    calls = []
+
+    def fake_run(cmd, cwd, timeout_s, tail=lc.LOG_TAIL_BYTES, env=None):
+        assert cmd[0] == "latexmk"
+        calls.append(cmd)
+        return log
+
+    monkeypatch.setattr(lc, "_run", fake_run)
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as z:
+        z.writestr("main.tex", "\\documentclass{article}\\begin{document}\\end{document}")
+    with pytest.raises(RuntimeError, match="PDF not produced"):
+        lc.compile_zip_to_pdf(buf, tmp_path / "out.pdf")
+    assert len(calls) == runs
+    assert ("-fmt=" in calls[0][3]) and ("-fmt=" not in calls[-1][3] or runs == 1)
+
+
+def test_out_dir_mirrors_source_subdirs(tmp_path, monkeypatch):
+    monkeypatch.setattr(lc, "_precompiled_format", lambda *args: None)
+    seen = []
+
+    def fake_run(cmd, cwd, timeout_s, tail=lc.LOG_TAIL_BYTES, env=None):
+        assert cmd[0] == "latexmk"
+        out_dir = Path(next(a for a in cmd if a.startswith("-outdir=")).split("=", 1)[1])
+        seen.extend(sorted(str(p.relative_to(out_dir)) for p in out_dir.rglob("*") if p.is_dir()))
+        (out_dir / "main.pdf").write_bytes(b"%PDF-1.5")
+        return ""
+
+    monkeypatch.setattr(lc, "_run", fake_run)
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as z:
+        z.writestr("main.tex", "\\documentclass{article}\\begin{document}\\include{chapters/sub/one}\\end{document}")
+        z.writestr("chapters/sub/one.tex", "One.")
+        z.writestr("figs/", "")
+    lc.compile_zip_to_pdf(buf, tmp_path / "out.pdf")
+    assert seen == ["chapters", "chapters/sub", "figs"]
+    assert (tmp_path / "out.pdf").read_bytes() == b"%PDF-1.5"
+
+
+# --- pdflatex fallback convergence --------------------------------------------
+
+
+def _fake_pdflatex(monkeypatch, aux_for_pass):
+    calls = []
+
+    def fake_run(cmd, cwd, timeout_s, tail=lc.LOG_TAIL_BYTES, env=None):
+        if cmd[0] == "latexmk":
+            raise FileNotFoundError(cmd[0])
+        assert cmd[0] == "pdflatex"
+        calls.append(cmd)
+        out_dir = Path(next(a for a in cmd if a.startswith("-output-directory=")).split("=", 1)[1])
+        (out_dir / "main.aux").write_text(aux_for_pass(len(calls)))
+        (out_dir / "main.fls").write_text(
+            f"PWD {cwd}\n"
+            "INPUT /usr/share/texmf/tex/latex/base/article.cls\n"
+            "INPUT ./main.tex\n"
+            f"INPUT {out_dir}/main.aux\n"
+            f"OUTPUT {out_dir}/main.aux\n"
+            f"OUTPUT {out_dir}/main.log\n"
+        )
+        return ""
+
+    monkeypatch.setattr(lc, "_run", fake_run)
+    return calls
+
+
+def _project(tmp_path):
+    main = tmp_path / "src" / "main.tex"
+    main.parent.mkdir()
+    main.write_text("\\documentclass{article}\\begin{document}\\end{document}")
+    out_dir = tmp_path / "out"
+    out_dir.mkdir()
+    return main, out_dir
+
+
+def test_fallback_stops_after_two_passes_when_aux_is_stable(tmp_path, monkeypatch):
+    calls = _fake_pdflatex(monkeypatch, lambda n: "\\relax\n")
+    main, out_dir = _project(tmp_path)
+    lc._compile_tex(main, None, out_dir)
+    assert len(calls) == 2
+
+
+def test_fallback_reruns_until_aux_converges(tmp_path, monkeypatch):
+    calls = _fake_pdflatex(monkeypatch, lambda n: f"\\newlabel{{x}}{{{min(n, 2)}}}\n")
+    main, out_dir = _project(tmp_path)
+    lc._compile_tex(main, None, out_dir)
+    assert len(calls) == 3
+
+
+def test_fallback_caps_passes(tmp_path, monkeypatch):
+    calls = _fake_pdflatex(monkeypatch, lambda n: f"\\newlabel{{x}}{{{n}}}\n")
+    main, out_dir = _project(tmp_path)
+    lc._compile_tex(main, None, out_dir)
+    assert len(calls) == lc.MAX_LATEX_PASSES
+
+
+def test_rerun_state_tracks_files_written_and_read_back(tmp_path):
+    (tmp_path / "main.aux").write_text("a")
+    (tmp_path / "main.toc").write_text("t")
+    (tmp_path / "fig.png").write_text("p")
+    (tmp_path / "main.fls").write_text(
+        "INPUT ./main.aux\nINPUT main.toc\nINPUT fig.png\n"
+        "OUTPUT main.aux\nOUTPUT ./main.toc\nOUTPUT main.log\n"
+    )
+    state = lc._rerun_state(tmp_path, tmp_path, "main")
+    assert sorted(Path(p).name for p in state) == ["main.aux", "main.toc"]
+
+
+# --- bibliography guard -------------------------------------------------------
+
+
+def _fake_bib_run(monkeypatch, aux, bcf=None):
+    calls = []
+
+    def fake_run(cmd, cwd, timeout_s, tail=lc.LOG_TAIL_BYTES, env=None):
+        if cmd[0] == "latexmk":
+            raise FileNotFoundError(cmd[0])
+        calls.append((cmd, cwd, env))
+        if cmd[0] == "pdflatex":
+            out_dir = Path(next(a for a in cmd if a.startswith("-output-directory=")).split("=", 1)[1])
+            (out_dir / "main.aux").write_text(aux)
+            if bcf is not None:
+                (out_dir / "main.bcf").write_text(bcf)
+        return ""
+
+    monkeypatch.setattr(lc, "_run", fake_run)
+    return calls
+
+
+@pytest.mark.parametrize("aux", ["\\relax\n", "\\newlabel{x}{1}\n"])
+def test_no_bibliography_tool_without_citations(tmp_path, monkeypatch, aux):
+    calls = _fake_bib_run(monkeypatch, aux)
+    main, out_dir = _project(tmp_path)
+    lc._compile_tex(main, None, out_dir)
+    assert {cmd[0] for cmd, _, _ in calls} == {"pdflatex"}
+
+
+def test_bibtex_runs_in_out_dir_with_sources_on_search_path(tmp_path, monkeypatch):
+    calls = _fake_bib_run(monkeypatch, "\\citation{knuth}\n\\bibdata{refs}\n")
+    main, out_dir = _project(tmp_path)
+    lc._compile_tex(main, None, out_dir)
+    bib = [(cmd, cwd, env) for cmd, cwd, env in calls if cmd[0] != "pdflatex"]
+    assert len(bib) == 1
+    cmd, cwd, env = bib[0]
+    assert cmd == ["bibtex", "main"]
+    assert cwd == out_dir
+    assert env["BIBINPUTS"].split(os.pathsep)[0] == str(main.parent)
+    assert env["BSTINPUTS"] == env["BIBINPUTS"]
+
+
+def test_biber_runs_when_bcf_declares_datasource(tmp_path, monkeypatch):
+    calls = _fake_bib_run(
+        monkeypatch,
+        "\\citation{knuth}\n",
+        bcf='<bcf:bibdata section="0"><bcf:datasource type="file">refs.bib</bcf:datasource></bcf:bibdata>',
+    )
+    main, out_dir = _project(tmp_path)
+    lc._compile_tex(main, None, out_dir)
+    bib = [cmd for cmd, _, _ in calls if cmd[0] != "pdflatex"]
+    assert bib == [["biber", f"--output-directory={out_dir}", "main"]]